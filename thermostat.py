@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
 # Base modules needed by thermostat
-import configparser
 import sys
 import time
 import os
-import argparse
 import logging
+import json
+import re
+from array import array
+from bisect import bisect_right
 
 # Initialize logging
 log = logging.getLogger("thermostat")
 log.addHandler(logging.NullHandler())
 
+# Sensor polling period in milliseconds, and the longer period used while the
+# temperature is well clear of the points where the thermostat switches
+POLL_PERIOD = 2000
+SETTLED_POLL_PERIOD = 10000
+
 # OpenHardwareMonitorLib.dll is only 32-bit, so application must be 32-bit!
 if sys.maxsize > 2**32:
     raise Exception("OpenHardwareMonitorLib is only 32-bit")
@@ -29,16 +36,17 @@ import win32gui_struct
 import win32event
 import winerror
 
-# Just for creating dialog popups
-import win32ui
-
 # To run the win32 window messagepump; should be in its own thread
 import threading
 
+# CfgMgr32 lists the present device interfaces without opening each device
+# https://docs.microsoft.com/en-us/windows/win32/api/cfgmgr32/nf-cfgmgr32-cm_get_device_interface_listw
+import ctypes
+import uuid
+
 # Needs 32-bit hidapi.dll and lib in same directory as binary, or os.getcwd()
 # https://docs.microsoft.com/en-us/windows/win32/dlls/dynamic-link-library-search-order#standard-search-order-for-desktop-applications
 import hid
-import ctypes
 
 # Meeds 32-bit OpenHardwareMonitorLib.dll in same directory as binary or sys.path
 # **Must run as administrator!**
@@ -47,6 +55,10 @@ import clr
 clr.AddReference('OpenHardwareMonitorLib')
 from OpenHardwareMonitor import Hardware
 
+# USB IDs may be ints or strings in decimal or prefixed (0x...) form
+def parse_id(x):
+    return x if isinstance(x, int) else int(x, 0)
+
 class Thermostat():
     def __init__(self, *args, **kwargs):
         if len(args) % 2:
@@ -67,85 +79,129 @@ class Thermostat():
         if len(self.__tmap.keys()) < 2:
             raise Exception("Thermostat requires at least 2 settings (hi/lo)")
         
-        # Need lowest, second lowest, and highest to set thermostat ranges
-        keys = sorted(self.__tmap.keys())
-        tmin = keys[0]
-        t1 = keys[1]
-        tmax = keys[-1]
-        
-        # Simplifying
-        fail = (None, False)
-        
-        # The below min, and above max ranges are special
-        self.__ranges = {
-            lambda t: t < t1 + fhyst:
-                lambda t: (self.__tmap[tmin], True) if t < (t1 + fhyst) else fail,
-            lambda t: t >= tmax + fhyst:
-                lambda t: (self.__tmap[tmax], True) if t > (tmax - rhyst) else fail,
-        }
+        # Thresholds sorted ascending, with the mode for each in a parallel tuple
+        thresh = array('i', sorted(self.__tmap.keys()))
+        self.__modes = tuple(self.__tmap[k] for k in thresh)
         
-        # Remaining hysteresis ranges filled in dynamically
-        def middle_range(low, hi, target):
-            forward = lambda t: t >= (low + fhyst) and t < (hi + fhyst)
-            reverse = lambda t: (self.__tmap[low], True) if t > (low - rhyst) and t < (hi + fhyst) else fail
-            target[forward] = reverse
-        for i in range(1, len(keys)-1):
-            middle_range(keys[i], keys[i+1], self.__ranges)
-        
-        # Set the mode to a function which always returns False
-        self.__hrange = lambda t: fail
-        
-    def mode(self, temperature, changes=True, unchanged=None):
-        newmode, hasmode = self.__hrange(temperature)
-        if not hasmode:
-            self.__hrange = next(self.__ranges[f] for f in self.__ranges.keys() if f(temperature))
-            newmode = self.__hrange(temperature)[0]
-        try:
-            mode = unchanged if self.__last == newmode and changes else newmode
-        except AttributeError:
-            mode = newmode
-        self.__last = newmode
-        return mode
+        # A mode is entered at its threshold plus forward hysteresis, and held
+        # until the temperature drops to its threshold minus reverse hysteresis
+        self.__fwd = array('i', (k + fhyst for k in thresh))
+        rev = [k - rhyst for k in thresh]
+        
+        # The configuration never changes, so resolve each mode's hold window
+        # (exclusive) up front. Lowest and highest modes are unbounded on one
+        # side, and the trailing empty window is what index -1 (no mode) sees.
+        inf = float("inf")
+        self.__hold = tuple(zip([-inf] + rev[1:], list(self.__fwd[1:]) + [inf])) + ((inf, -inf),)
+        
+        # Readings this far inside the hold window won't switch modes soon
+        self.__slack = 2 * max(fhyst, rhyst)
+        
+        # No mode until the first reading
+        self.__cur_idx = -1
+        
+        # Last reading; a steady temperature needs no lookup
+        self.__last_t = None
+        
+        # Index of the mode last returned by mode(), -1 before the first
+        self.__last_idx = -1
+    
+    # Modes in ascending temperature order, as indexed by mode_index()
+    @property
+    def modes(self):
+        return self.__modes
+    
+    def mode_index(self, temperature):
+        if temperature == self.__last_t:
+            return self.__cur_idx
+        
+        idx = self.__cur_idx
+        lo, hi = self.__hold[idx]
+        if not lo < temperature < hi:
+            idx = max(bisect_right(self.__fwd, temperature) - 1, 0)
+            self.__cur_idx = idx
+        self.__last_t = temperature
+        return idx
+        
+    # Index of the mode, or 'unchanged' if it's the same as the last returned.
+    # By default that's -1, which indexes the no-op of VoltageSwitch.dispatch()
+    def mode(self, temperature, unchanged=-1):
+        idx = self.mode_index(temperature)
+        last, self.__last_idx = self.__last_idx, idx
+        if idx == last:
+            return unchanged
+        return idx
+    
+    # Makes the next mode() call return the mode, even if it's unchanged
+    def force_next(self):
+        self.__last_idx = -1
+    
+    # Whether the temperature is well inside the current mode's hold window.
+    # Without hysteresis there's no margin, so it's never considered settled.
+    def settled(self, temperature):
+        lo, hi = self.__hold[self.__cur_idx]
+        return self.__slack > 0 and lo + self.__slack < temperature < hi - self.__slack
 
 
 class VoltageSwitch(hid.Device):
     # Didn't lookup the byte order and since only looking for bytes . . .
-    v12 = ctypes.create_string_buffer(b'\x01'*64, 64)
-    v5 = ctypes.create_string_buffer(b'\x00'*64, 64)
-    v0 = ctypes.create_string_buffer(b'\x02'*64, 64)
+    v12 = b'\x01'*64
+    v5 = b'\x00'*64
+    v0 = b'\x02'*64
+    
+    # Reports by voltage level; every write of a level sends the same bytes
+    reports = {12: v12, 5: v5, 0: v0}
 
     def __init__(self, vid=None, pid=None, serial=None, path=None):
         if vid and pid:
-            try:
-                vid, pid = map(int, vid, pid)
-            except ValueError:
-                vid, pid = map(lambda i: int(i, 0), vid, pid)
-        self.__switch = {
-                            '12v': self.set12v,
-                            '5v': self.set5v,
-                            '0v': self.set0v,
-                            None: lambda *args: None,
-                        }
+            vid, pid = parse_id(vid), parse_id(pid)
         super().__init__(vid, pid, serial, path)
+        
+        # Bound once, rather than on every write
+        self.__write = self.write
+        
+        # Last report written to the device, so repeats can be skipped
+        self.__last = None
+    
+    def setv(self, level):
+        report = VoltageSwitch.reports[level]
+        if report is self.__last:
+            return 0
+        log.debug("Setting voltage switch to %iV", level)
+        written = self.__write(report)
+        self.__last = report
+        return written
     
     def set12v(self):
-        log.debug("Setting voltage switch to 12V")
-        return self.write(VoltageSwitch.v12)
+        return self.setv(12)
     
     def set5v(self):
-        log.debug("Setting voltage switch to 5V")
-        return self.write(VoltageSwitch.v5)
+        return self.setv(5)
     
     def set0v(self):
-        log.debug("Setting voltage switch to 0V")
-        return self.write(VoltageSwitch.v0)
+        return self.setv(0)
     
-    def __getitem__(self, key):
-        return self.__switch[key]
+    def __noop(self):
+        return None
+    
+    # Handlers for each mode in order, followed by a no-op, for tuple indexing
+    def dispatch(self, modes):
+        switch = {'12v': self.set12v, '5v': self.set5v, '0v': self.set0v}
+        return tuple(switch[m] for m in modes) + (self.__noop,)
 
 
 class TemperatureSensor():
-    def __init__(self, device=None, sensor=None, cpu=True, ram=False, gpu=False, mobo=False, disk=False):
+    # Failed updates in a row, or ttl periods a single update may take, before
+    # the last good value is distrusted
+    STALE_UPDATES = 10
+    
+    # ttl periods without a reading before the poller stops updating
+    IDLE_UPDATES = 3
+
+    def __init__(self, device=None, sensor=None, cpu=True, ram=False, gpu=False, mobo=False, disk=False, ttl=2.0):
+        # OpenHardwareMonitor sensors can't be updated individually; an update
+        # refreshes every sensor of the hardware. Only the hardware classes
+        # enabled here are ever opened, and only the device is ever updated.
         self.__handle = Hardware.Computer()
         self.__handle.CPUEnabled = cpu
         self.__handle.MainboardEnabled = mobo
@@ -154,31 +210,114 @@ class TemperatureSensor():
         self.__handle.HDDEnabled = disk
         self.__handle.Open()
         
-        if len(self.__handle.Hardware) < 1:
+        # Index the CLR collections by name in a single pass; first name wins
+        hardware = {}
+        for h in self.__handle.Hardware:
+            hardware.setdefault(h.Name, h)
+        
+        if not hardware:
             raise Exception("No hardware was detected")
 
         try:
-            self.__hardware = next(h for h in self.__handle.Hardware if h.Name == device)
-        except:
+            self.__hardware = hardware[device]
+        except KeyError:
             raise Exception("Device '%s' not detected.\r\n\r\nAvailable devices:\r\n%s"
-                            %(device, '\r\n'.join(sorted(f"- {h.Name}" for h in self.__handle.Hardware))))
+                            %(device, '\r\n'.join(sorted(f"- {n}" for n in hardware))))
             
         # Poll device
         self.__hardware.Update()
 
+        sensors = {}
+        for s in self.__hardware.Sensors:
+            if s.SensorType == 2:
+                sensors.setdefault(s.Name, s)
+        
         try:
-            self.__sensor = next(s for s in self.__hardware.Sensors if s.SensorType == 2 and s.Name == sensor)
-        except:
+            self.__sensor = sensors[sensor]
+        except KeyError:
             raise Exception("Sensor '%s' not found.\r\n\r\nAvailable sensors:\r\n%s"
-                            %(sensor, '\r\n'.join(sorted(f"- {s.Name}" for s in self.__hardware.Sensors if s.SensorType == 2))))
+                            %(sensor, '\r\n'.join(sorted(f"- {n}" for n in sensors))))
         
         self.value = self.__sensor.Value
+        
+        # Hardware.Update() is slow, so it runs every ttl seconds on its own
+        # thread while readings are wanted; reading() returns the latest value,
+        # at most ttl seconds old. Without readings, the thread idles.
+        self.__ttl = float(ttl)
+        self.__started = None
+        
+        # A sensor without a value reads as overheated until its first good update
+        self.__failures = 0 if self.value is not None else TemperatureSensor.STALE_UPDATES
+        self.__closed = threading.Event()
+        self.__wanted = threading.Event()
+        self.__fresh = threading.Event()
+        self.__fresh.set()
+        self.__poller = threading.Thread(target=self.__poll, name="TemperatureSensor", daemon=True)
+        self.__poller.start()
+    
+    def __poll(self):
+        idle = 0
+        while True:
+            if self.__wanted.is_set():
+                self.__wanted.clear()
+                idle = 0
+            elif idle < TemperatureSensor.IDLE_UPDATES:
+                idle += 1
+            else:
+                # Nothing has read the sensor for a while; idle until something does
+                self.__fresh.clear()
+                self.__wanted.wait()
+                self.__wanted.clear()
+                idle = 0
+            if self.__closed.is_set():
+                return
+            
+            # Start of the update in flight, so reading() can tell it has hung
+            self.__started = time.monotonic()
+            try:
+                self.__hardware.Update()
+                
+                # Value is nullable; no value is no better than a failed update
+                value = self.__sensor.Value
+                if value is None:
+                    raise Exception("Sensor '%s' has no value" % self.__sensor.Name)
+                
+                self.value = value
+                self.__failures = 0
+                log.debug("Temperature reading: %i", self.value)
+            except:
+                # Keep the last good value; only log the first of a run of failures
+                self.__failures += 1
+                if self.__failures == 1:
+                    log.exception("Failed to update temperature sensor")
+                elif self.__failures == TemperatureSensor.STALE_UPDATES:
+                    log.error("Temperature sensor still failing; reporting it as overheated")
+            self.__started = None
+            self.__fresh.set()
+            
+            # Waiting on the event paces the updates, and close() ends them
+            if self.__closed.wait(self.__ttl):
+                return
     
     def reading(self):
-        self.__hardware.Update()
-        self.value = self.__sensor.Value
-        log.debug("Temperature reading: %i", self.value)
+        # Keeps the poller updating; if it had gone idle, its value is old, so
+        # wait (at most ttl) for the update this wakes it for
+        self.__wanted.set()
+        self.__fresh.wait(self.__ttl)
+        
+        # Failed updates leave the last good value, so a sensor hiccup doesn't
+        # drop the HID connection with it. A sensor that keeps failing, or an
+        # update that hangs, reads as infinitely hot, so the switch goes to its
+        # highest mode rather than staying wherever the last good value left it.
+        started = self.__started
+        if (self.__failures >= TemperatureSensor.STALE_UPDATES or
+                started is not None and time.monotonic() - started > self.__ttl * TemperatureSensor.STALE_UPDATES):
+            return float("inf")
         return self.value
+    
+    def close(self):
+        self.__closed.set()
+        self.__wanted.set()
 
 
 class Win32HID(threading.Event):
@@ -187,12 +326,18 @@ class Win32HID(threading.Event):
     # USB Device works, but HID device is more specific. Both listed anyway
     GUID_DEVINTERFACE_USB_DEVICE = "{A5DCBF10-6530-11D2-901F-00C04FB951ED}"
     GUID_DEVINTERFACE_HID = "{4D1E55B2-F16F-11CF-88CB-001111000030}"
+    
+    # From cfgmgr32.h
+    CM_GET_DEVICE_INTERFACE_LIST_PRESENT = 0
+    CR_SUCCESS = 0
+    CR_BUFFER_SMALL = 0x1A
 
     def __init__(self, device=hid.Device, vid=None, pid=None, path=None):
         # Initialize the base class event object
         super().__init__()
     
         # Path must be convertable to bytes, and vid/pid integers
+        self.__path_re = None
         if path:
             try:
                 self.__path = path.lower().encode()
@@ -204,18 +349,24 @@ class Win32HID(threading.Event):
             except hid.HIDException:
                 pass
         elif vid and pid:
-            try:
-                v, p = map(lambda x: int(x),[vid,pid])
-            except:
-                v, p = map(lambda x: int(x, 0),[vid,pid])
+            v, p = parse_id(vid), parse_id(pid)
             
-            # The IDs are only used to find the full device path
-            self.__ids = list(f"{x}_{y:04x}".encode() for x, y in zip(["vid","pid"],[v,p]))
+            # The IDs are only used to find the full device path; matches the
+            # first interface (if any) of the device with the HID class GUID
+            vid = rb"(?=(?:[^#&]*&)*vid_%04x[&#])" % v  # VID token somewhere in the IDs
+            pid = rb"(?=(?:[^#&]*&)*pid_%04x[&#])" % p  # PID token somewhere in the IDs
+            token = rb"(?:mi_00|(?!mi_)[^#&]*)"         # any '&' token but other interfaces
+            guid = re.escape(Win32HID.GUID_DEVINTERFACE_HID.lower().encode())
+            self.__path_re = re.compile(rb"[^#]*#"            # e.g. '\\\\?\\hid'
+                                        rb"%s%s%s(?:&%s)*"    # IDs, in any order
+                                        rb"(?:#[^#]*)*"       # instance
+                                        rb"#%s\Z"             # interface class
+                                        %(vid, pid, token, token, guid))
             
             # Always use path for connection; check for device at startup
             self.__path = None
-            for d in hid.enumerate(vid=v, pid=p):
-                if self.__matchingdevice(d["path"]):
+            for name in Win32HID.interfaces(Win32HID.GUID_DEVINTERFACE_HID):
+                if self.__matchingdevice(name):
                     super().set()
                     break
         else:
@@ -247,11 +398,50 @@ class Win32HID(threading.Event):
                                                         win32con.DEVICE_NOTIFY_WINDOW_HANDLE)
 
 
+    # Paths of the present device interfaces of a device interface class
+    @staticmethod
+    def interfaces(guid):
+        cfgmgr32 = ctypes.WinDLL("CfgMgr32")
+        cls = (ctypes.c_char * 16).from_buffer_copy(uuid.UUID(guid).bytes_le)
+        size = ctypes.c_ulong()
+        
+        # The list can grow between the two calls, so retry until it fits
+        cr = Win32HID.CR_BUFFER_SMALL
+        while cr == Win32HID.CR_BUFFER_SMALL:
+            cr = cfgmgr32.CM_Get_Device_Interface_List_SizeW(ctypes.byref(size), cls, None,
+                                                             Win32HID.CM_GET_DEVICE_INTERFACE_LIST_PRESENT)
+            if cr != Win32HID.CR_SUCCESS:
+                break
+            buf = ctypes.create_unicode_buffer(size.value)
+            cr = cfgmgr32.CM_Get_Device_Interface_ListW(cls, None, buf, size,
+                                                        Win32HID.CM_GET_DEVICE_INTERFACE_LIST_PRESENT)
+        if cr != Win32HID.CR_SUCCESS:
+            raise Exception("Unable to list device interfaces (CONFIGRET 0x%02X)" % cr)
+        
+        # A list of null terminated strings, ending with an empty string
+        return [name for name in buf[:size.value].split("\0") if name]
+
+
     # Added only for ergonomics
     def attached(self):
         return self.is_set()
         
     
+    # Pumps window messages until WM_QUIT is received. Drains the queue once
+    # per wake, rather than waking on every message like PumpMessages.
+    def messageloop(self):
+        # There must be an event to wait for even if its not used. Otherwise
+        # MsgWaitForMultipleObjects will just return immediately.
+        idle = win32event.CreateEvent(None, 0, 0, None)
+        while not win32gui.PumpWaitingMessages():
+            win32event.MsgWaitForMultipleObjectsEx(
+                (idle,), # list of objects
+                win32event.INFINITE, # timeout
+                win32event.QS_ALLINPUT, # type of input
+                win32event.MWMO_INPUTAVAILABLE, # also wake for input already seen
+                )
+        
+    
     def device(self, timeout=None):
         if not self.wait(timeout):
             raise Exception("Device not attached")
@@ -269,19 +459,18 @@ class Win32HID(threading.Event):
         
         if self.__path and self.__path == path:
             return True
-        elif self.__ids:
-            chunks = path.split(b'#')
-            if len(chunks) > 2 and chunks[-1] == Win32HID.GUID_DEVINTERFACE_HID.encode().lower():
-                ids = chunks[1].split(b'&')
-                if (all(id in ids for id in self.__ids) and 
-                    all(id == b'mi_00' for id in ids if id.startswith(b'mi_'))):
-                    self.__path = path
-                    return True
+        elif self.__path_re and self.__path_re.match(path):
+            self.__path = path
+            return True
         return False
 
 
     # WM_DEVICECHANGE message handler.
     def __devicechange(self, hWnd, msg, wParam, lParam):
+        # Only arrival and removal can concern us, so don't unpack the rest
+        if wParam not in (win32con.DBT_DEVICEARRIVAL, win32con.DBT_DEVICEREMOVECOMPLETE):
+            return True
+        
         info = win32gui_struct.UnpackDEV_BROADCAST(lParam)
         
         if (info.devicetype == win32con.DBT_DEVTYP_DEVICEINTERFACE and
@@ -301,6 +490,9 @@ class TrayThermostat(threading.Thread):
     V0 = 1026
     Exit = 1027
     Connected = 1028
+    
+    # Menu items which are checked when they're the current mode
+    Modes = (Automatic, V12, V5, V0)
 
     def __init__(self, w32hid, sensor, thermostat):
         threading.Thread.__init__(self)
@@ -308,24 +500,35 @@ class TrayThermostat(threading.Thread):
         self.__sensor = sensor
         self.__thermostat = thermostat
         
-        # Pre-initialize a dummy event for the ticker based msg pump
-        self.__event = win32event.CreateEvent(None, 0, 0, None)
+        # Periodic timer for the ticker based msg pump; armed in run()
+        self.__timer = win32event.CreateWaitableTimer(None, False, None)
+        self.__period = None
     
-    def __wait_msg_pump(self, timeout=2000):
+    def __set_poll_period(self, period):
+        # Only re-arm the timer when the period actually changes
+        if period != self.__period:
+            arm_timer(self.__timer, period)
+            self.__period = period
+    
+    def __wait_msg_pump(self, timeout=win32event.INFINITE):
         # When user does mouseover it runs QS_SENDMESSAGE 0x0040 in a loop . . .
         # Also we receive ALL mouse clicks . . .
-        rc = win32event.MsgWaitForMultipleObjects(
-                (self.__event,), # list of objects
-                0, # wait all
+        # MWMO_INPUTAVAILABLE also wakes for input that's queued but was already
+        # seen, so no events are missed between calls
+        rc = win32event.MsgWaitForMultipleObjectsEx(
+                (self.__timer,), # list of objects
                 timeout,  # timeout
                 win32event.QS_ALLINPUT, # type of input
+                win32event.MWMO_INPUTAVAILABLE, # flags
                 )
         if rc == win32event.WAIT_OBJECT_0+1:
             # Message waiting.
             if win32gui.PumpWaitingMessages():
-                # Received WM_QUIT, so return True.
+                # Received WM_QUIT, so return None.
                 win32gui.PostMessage(self.__w32hid.hwnd, win32con.WM_QUIT, 0, 0)
-                return True
+                return None
+        # True only when it's time to poll
+        return rc == win32event.WAIT_OBJECT_0
     
     def run(self):
         self.__mode = TrayThermostat.Automatic
@@ -361,63 +564,78 @@ class TrayThermostat(threading.Thread):
                 0, 0, hinst, None)
         win32gui.UpdateWindow(self.hwnd)
         self._DoCreateIcons()
+        self.__menu = self.__create_menu()
+        
+        self.__set_poll_period(POLL_PERIOD)
+        
+        # Looked up once, rather than on every pass through the loops
+        wait = self.__wait_msg_pump
+        attached = self.__w32hid.attached
+        reading = self.__sensor.reading
+        thermostat = self.__thermostat
         
-        # There must be an event to wait for even if its not used. Otherwise
-        # MsgWaitForMultipleObjects will just return immediately.
-        last_poll = 0
         while True:
             # If we're here, then we're not connected.
             self.__connected = False
             
-            # MsgWaitForMultiple objects will miss events between calls
-            if win32gui.PumpWaitingMessages():
-                return
-        
+            # Device arrival is flagged by the Win32HID message handler, so
+            # just service GUI messages until then, checking every 300 ms
+            if not attached():
+                if wait(timeout=300) is None:
+                    return
+                continue
+            
             try:
                 # Wait 0.2 seconds for the device (so as not to delay win32 Message Loop)
                 with self.__w32hid.device(timeout=0.2) as vs:
                     # If we made it here, then we're connected
                     self.__connected = True
                     
+                    # Switch handlers indexed by thermostat mode, and by manual mode
+                    switch = vs.dispatch(thermostat.modes)
+                    manual = {
+                        TrayThermostat.V12: vs.set12v,
+                        TrayThermostat.V5: vs.set5v,
+                        TrayThermostat.V0: vs.set0v,
+                    }
+                    
                     # On the first reading always set the switch state
-                    changes = False
+                    thermostat.force_next()
                     
                     while True:
-                        # MsgWaitForMultiple objects will miss events between calls
-                        if win32gui.PumpWaitingMessages():
-                            return
-                        
                         # Now we wait . . .
-                        if self.__wait_msg_pump():
+                        polled = wait()
+                        if polled is None:
                             return
                         
-                        if (time.time() * 1000) - last_poll >= 2000:
-                            last_poll = time.time() * 1000
-                            
+                        if polled:
                             # Set the voltage switch based on our current mode
                             if self.__mode == TrayThermostat.Automatic:
-                                # Send the sensor reading to the thermostat for the voltage switch
-                                if not vs[self.__thermostat.mode(self.__sensor.reading(), changes)]():
-                                    # If no command sent, check to ensure still connected
-                                    if not self.__w32hid.attached():
-                                        break
+                                # Send the sensor reading to the thermostat for the voltage switch;
+                                # from now on, only set switch state on changes
+                                temperature = reading()
+                                sent = switch[thermostat.mode(temperature)]()
                                 
-                                # From now on, only set switch state on changes
-                                changes = True
-                            elif self.__mode == TrayThermostat.V12:
-                                vs.set12v()
-                                changes = False
-                            elif self.__mode == TrayThermostat.V5:
-                                vs.set5v()
-                                changes = False
-                            elif self.__mode == TrayThermostat.V0:
-                                vs.set0v()
-                                changes = False
+                                # Poll less often while nowhere near switching
+                                self.__set_poll_period(SETTLED_POLL_PERIOD if thermostat.settled(temperature)
+                                                       else POLL_PERIOD)
+                            else:
+                                # Returning to automatic always sets the switch state
+                                thermostat.force_next()
+                                self.__set_poll_period(POLL_PERIOD)
+                                sent = manual[self.__mode]()
+                            
+                            # If no command sent, check to ensure still connected
+                            if not sent and not attached():
+                                break
             except:
                 log.exception("Terminated HID connection")
             
+            # Every connection starts at the normal period, whatever it was left at
+            self.__set_poll_period(POLL_PERIOD)
+            
             # Now we wait 300 milliseconds for GUI messages
-            if self.__wait_msg_pump(timeout=300):
+            if wait(timeout=300) is None:
                 return
 
 
@@ -443,6 +661,18 @@ class TrayThermostat(threading.Thread):
             # TaskbarCreated message.
 
 
+    def __create_menu(self):
+        # Only the check marks and connection label change, so create it once
+        menu = win32gui.CreatePopupMenu()
+        win32gui.AppendMenu( menu, win32con.MF_GRAYED | win32con.MF_STRING, TrayThermostat.Connected, "Disconnected")
+        win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.Automatic, "Automatic")
+        win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.V12, "12V")
+        win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.V5, "5V" )
+        win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.V0, "Off" )
+        win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.Exit, "Exit" )
+        return menu
+
+
     def OnRestart(self, hwnd, msg, wparam, lparam):
         self._DoCreateIcons()
 
@@ -450,25 +680,22 @@ class TrayThermostat(threading.Thread):
     def OnDestroy(self, hwnd, msg, wparam, lparam):
         nid = (self.hwnd, 0)
         win32gui.Shell_NotifyIcon(win32gui.NIM_DELETE, nid)
+        win32gui.DestroyMenu(self.__menu)
         win32gui.PostMessage(self.__w32hid.hwnd, win32con.WM_QUIT, 0, 0) # Terminate win32hid
         win32gui.PostQuitMessage(0) # Terminate the app.
 
-    def __flag_set(self, mode):
-        return win32con.MF_STRING | win32con.MF_CHECKED if self.__mode == mode else win32con.MF_STRING
-
     def OnTaskbarNotify(self, hwnd, msg, wparam, lparam):
         if lparam==win32con.WM_LBUTTONUP:
             pass
         elif lparam==win32con.WM_LBUTTONDBLCLK:
             win32gui.DestroyWindow(self.hwnd)
         elif lparam==win32con.WM_RBUTTONUP:
-            menu = win32gui.CreatePopupMenu()
-            win32gui.AppendMenu( menu, win32con.MF_GRAYED | win32con.MF_STRING, TrayThermostat.Connected, "Connected" if self.__connected else "Disconnected")
-            win32gui.AppendMenu( menu, self.__flag_set(TrayThermostat.Automatic), TrayThermostat.Automatic, "Automatic")
-            win32gui.AppendMenu( menu, self.__flag_set(TrayThermostat.V12), TrayThermostat.V12, "12V")
-            win32gui.AppendMenu( menu, self.__flag_set(TrayThermostat.V5), TrayThermostat.V5, "5V" )
-            win32gui.AppendMenu( menu, self.__flag_set(TrayThermostat.V0), TrayThermostat.V0, "Off" )
-            win32gui.AppendMenu( menu, win32con.MF_STRING, TrayThermostat.Exit, "Exit" )
+            menu = self.__menu
+            win32gui.ModifyMenu( menu, TrayThermostat.Connected, win32con.MF_BYCOMMAND | win32con.MF_GRAYED | win32con.MF_STRING,
+                                 TrayThermostat.Connected, "Connected" if self.__connected else "Disconnected")
+            for mode in TrayThermostat.Modes:
+                check = win32con.MF_CHECKED if self.__mode == mode else win32con.MF_UNCHECKED
+                win32gui.CheckMenuItem( menu, mode, win32con.MF_BYCOMMAND | check )
             pos = win32gui.GetCursorPos()
             # See http://msdn.microsoft.com/library/default.asp?url=/library/en-us/winui/menus_0hdi.asp
             win32gui.SetForegroundWindow(self.hwnd)
@@ -484,26 +711,81 @@ class TrayThermostat(threading.Thread):
         else:
             log.debug("Setting mode - %i", id)
             self.__mode = id
+            
+            # Don't leave a new mode waiting on a long settled poll period
+            self.__set_poll_period(POLL_PERIOD)
+
+# (Re)arms a periodic waitable timer, first firing one period from now
+def arm_timer(timer, period):
+    win32event.SetWaitableTimer(timer, -period * 10000, period, None, None, False)
+
 
 def mainloop(w32hid, sensor, thermostat):
-    while True:
+    # A periodic waitable timer paces the polling, and the same wait services
+    # the Win32HID window messages, so everything runs on a single thread.
+    timer = win32event.CreateWaitableTimer(None, False, None)
+    period = POLL_PERIOD
+    arm_timer(timer, period)
+    
+    # Wait for the next timer tick while pumping messages; False on WM_QUIT
+    def tick():
+        while True:
+            rc = win32event.MsgWaitForMultipleObjectsEx(
+                    (timer,), # list of objects
+                    win32event.INFINITE, # timeout
+                    win32event.QS_ALLINPUT, # type of input
+                    win32event.MWMO_INPUTAVAILABLE, # also wake for input already seen
+                    )
+            if rc == win32event.WAIT_OBJECT_0:
+                return True
+            if win32gui.PumpWaitingMessages():
+                return False
+    
+    # Looked up once, rather than on every pass through the loops
+    attached = w32hid.attached
+    reading = sensor.reading
+    mode = thermostat.mode
+    settled = thermostat.settled
+    
+    while tick():
+        # Device arrival is flagged by the Win32HID message handler
+        if not attached():
+            continue
+        
         try:
-            # Wait for the device, connect, then enter the context
+            # Connect to the device, then enter the context
             with w32hid.device() as vs:
+                # Switch handlers indexed by thermostat mode
+                switch = vs.dispatch(thermostat.modes)
+                
                 # On the first reading always set the switch state
-                changes = False
+                thermostat.force_next()
                 
                 while True:
-                    time.sleep(2)
+                    # Set the switch state by feeding sensor data into thermostat;
+                    # from now on, only set switch state on changes
+                    temperature = reading()
+                    if not switch[mode(temperature)]():
+                        # If no command sent, check to ensure still connected
+                        if not attached():
+                            break
                     
-                    # Set the switch state by feeding sensor data into thermostat
-                    vs[thermostat.mode(sensor.reading(), changes)]()
+                    # Poll less often while nowhere near switching
+                    wanted = SETTLED_POLL_PERIOD if settled(temperature) else POLL_PERIOD
+                    if wanted != period:
+                        period = wanted
+                        arm_timer(timer, period)
                     
-                    # From now on, only set switch state on changes
-                    changes = True
+                    if not tick():
+                        return
         except:
             log.exception("Terminated HID connection")
-            time.sleep(30)
+        
+        # Back to the normal period, so the device returning is noticed promptly
+        # and the next connection starts there
+        if period != POLL_PERIOD:
+            period = POLL_PERIOD
+            arm_timer(timer, period)
 
 
 def verify_config(config):
@@ -524,37 +806,84 @@ def verify_config(config):
         }
         config['probe'] = dict({
             "device": "Intel Core i7-6600U",
-            "sensor": "CPU Package"
+            "sensor": "CPU Package",
+            "ttl": "2.0"
         },**dict((t, "false" if t != "cpu" else "true") for t in types))
         with open('thermostat.ini', 'w') as configfile:
             config.write(configfile)
+        
+        # Just for creating dialog popups; only needed for startup errors
+        import win32ui
         win32ui.MessageBox("Config file 'thermostat.ini' not found. A new one has been created",
                            "Startup Error", win32con.MB_ICONERROR)
         sys.exit(1)
 
 
-def main(argv=None):
+# Settings frozen by --rebuild-config, so startup can skip parsing the INI
+FROZEN_CONFIG = 'thermostat.json'
+
+
+def config_settings(config):
     types = ["cpu", "ram", "gpu", "mobo", "disk"]
     
-    config = configparser.ConfigParser()
-    config.read('thermostat.ini')
-    
-    verify_config(config)
+    sensor_types = dict((t, config.getboolean("probe", t, fallback=False)) for t in types)
+    return {
+        "probe": dict(config["probe"], **sensor_types),
+        "microcontroller": dict(config["microcontroller"]),
+        "thermostat": dict(config["thermostat"]),
+    }
+
+
+def frozen_config():
+    # Frozen settings are ignored once 'thermostat.ini' has been edited, and
+    # an unreadable file just falls back to parsing the INI
+    try:
+        if os.path.getmtime(FROZEN_CONFIG) >= os.path.getmtime('thermostat.ini'):
+            with open(FROZEN_CONFIG, 'r') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def main(argv=None):
+    # Only needed at startup, so the imports are deferred until now
+    import argparse
     
     parser = argparse.ArgumentParser(description='HTPC Thermostat')
     parser.add_argument('--hidden', action='store_true', help='Do not display the track icon')
     parser.add_argument('--logfile', required=False, help='Enable debug logging to file')
+    parser.add_argument('--rebuild-config', action='store_true',
+                        help=f"Freeze 'thermostat.ini' into '{FROZEN_CONFIG}' and exit")
     args = parser.parse_args()
+    
+    settings = None if args.rebuild_config else frozen_config()
+    if settings is None:
+        # Not needed at all when the frozen settings are used
+        import configparser
+        config = configparser.ConfigParser()
+        config.read('thermostat.ini')
+        
+        verify_config(config)
 
     try:
-        sensor_types = dict((t, config.getboolean("probe", t, fallback=False)) for t in types)
-        s = TemperatureSensor(**dict(config["probe"], **sensor_types))
-        w = Win32HID(device=VoltageSwitch, **config['microcontroller'])
-        t = Thermostat(**config['thermostat'])
+        if settings is None:
+            settings = config_settings(config)
+        s = TemperatureSensor(**settings["probe"])
+        w = Win32HID(device=VoltageSwitch, **settings["microcontroller"])
+        t = Thermostat(**settings["thermostat"])
     except:
+        # Only needed for the error dialog
+        import win32ui
         win32ui.MessageBox(sys.exc_info()[1].args[0], "Startup Error", win32con.MB_ICONERROR)
         sys.exit(1)
     
+    # Only settings which started up successfully are frozen
+    if args.rebuild_config:
+        with open(FROZEN_CONFIG, 'w') as f:
+            json.dump(settings, f, indent=4)
+        return
+    
     if args.logfile:
         logging.basicConfig(
             format='%(asctime)-15s [%(levelname)s] %(threadName)s %(name)s - %(message)s',
@@ -562,20 +891,21 @@ def main(argv=None):
             filename=args.logfile)
     
     if args.hidden:
-        loop = threading.Thread(target=mainloop, args=(w, s, t))
-        loop.setDaemon(True)
-        loop.name = "VoltageSwitch"
-        loop.start()
-    else:
-        t = TrayThermostat(w, s, t)
-        t.name = "VoltageSwitch"
-        t.setDaemon(True)
-        t.start()
+        # Polls and pumps the Win32HID messages on this thread
+        mainloop(w, s, t)
+        s.close()
+        return
+    
+    t = TrayThermostat(w, s, t)
+    t.name = "VoltageSwitch"
+    t.setDaemon(True)
+    t.start()
     
     # Having trouble with thread scope; this only runs in main thread
     # or when class creating window is child of threading.Thread.
-    # PumpMessages runs until PostQuitMessage() is called by someone.
-    win32gui.PumpMessages()
+    # The message loop runs until PostQuitMessage() is called by someone.
+    w.messageloop()
+    s.close()
 
 
 if __name__ == '__main__':